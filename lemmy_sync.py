@@ -1,98 +1,242 @@
 import re
 import os
-import traceback
+import logging
 import json
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import make_headers
+from urllib3.util.retry import Retry
 import gzip
-from time import sleep, time
-from datetime import datetime, timedelta
-from typing import List
+import shutil
+import functools
+import signal
+from time import sleep, time, monotonic
+from datetime import datetime, timedelta, timezone
+from contextlib import contextmanager
+from itertools import groupby
+from typing import List, Union
 from urllib import parse
 
+try:
+    from orjson import dumps as json_dumps, loads as json_loads
+except ImportError:
+    # same bytes in, bytes out interface as orjson
+    def json_dumps(data) -> bytes:
+        return json.dumps(data, separators=(',', ':')).encode()
+    json_loads = json.loads
+
+logger = logging.getLogger(__name__)
+
 # main lemmy repo: https://github.com/LemmyNet/lemmy
 # js client with types for api: https://github.com/LemmyNet/lemmy-js-client
 
+# saved posts start with the post object and its id, so the id can be read
+# without parsing the rest of the record
+POST_ID_PATTERN = re.compile(rb'\{\s*"post"\s*:\s*\{\s*"id"\s*:\s*(\d+)')
+
+@contextmanager
+def deferred_stop_signals():
+    # a stop signal arriving inside the block is delivered once it is done, so
+    # files are never left half written
+    if not hasattr(signal, 'pthread_sigmask'):
+        yield
+        return
+    old_mask = signal.pthread_sigmask(signal.SIG_BLOCK, { signal.SIGINT, signal.SIGTERM })
+    try:
+        yield
+    finally:
+        signal.pthread_sigmask(signal.SIG_SETMASK, old_mask)
+
+# posts from a sync span only a handful of days, cache on the day part
+@functools.lru_cache(maxsize=4096)
+def parse_day(day_str: str) -> datetime:
+    return datetime(int(day_str[0:4]), int(day_str[5:7]), int(day_str[8:10]))
+
 def get_date(date_str: str) -> datetime:
-    return datetime.fromisoformat(date_str.split('T')[0])
+    return parse_day(date_str[:10])
 
 class LemmyApi:
     def __init__(self, base_url: str, request_interval: int, list_limit: int):
         self.base_url = base_url
-        self.last_request = time()
+        self.last_request = monotonic()
         self.list_limit = list_limit
         self.request_interval = request_interval
+        # grows when the server rate limits us, never drops below request_interval
+        self.current_interval = request_interval
         self.requests = []
+        # community info rarely changes, don't spend a rate limited call on it twice
+        self.community_cache = {}
+        # (community, sort) -> encoded post/list query without the page
+        self.posts_query_cache = {}
+        # url -> (etag, last modified, parsed response) for conditional requests
+        self.conditional_cache = {}
+        # reuse one connection to the server instead of a new handshake per call
+        self.session = requests.Session()
+        # only retry connections that never reached the server here, responses
+        # are retried in get_api so they go through the rate limit and request log
+        adapter = HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=20,
+            max_retries=Retry(connect=3, read=0, status=0, backoff_factor=0.5)
+        )
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({
+            'User-Agent': 'lemmy_data_sync',
+            'Accept': 'application/json',
+            # gzip and deflate, plus br when brotli is installed
+            'Accept-Encoding': make_headers(accept_encoding=True)['accept-encoding']
+        })
 
-    def get_api(self, path: str, query: dict, raw = False):
-        now = datetime.now().strftime("%m/%d/%Y, %H:%M:%S")
-        print(f'\n[{now}] Getting from api {path} with query {query}')
-        time_diff = time() - self.last_request
-        if time_diff < self.request_interval:
-            sleep_time = self.request_interval - time_diff
-            print(f'Sleeping for {sleep_time:.2f}s')
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def close(self):
+        # the session opens new connections the next time it is used
+        self.session.close()
+
+    def wait_for_rate_limit(self):
+        time_diff = monotonic() - self.last_request
+        if time_diff < self.current_interval:
+            sleep_time = self.current_interval - time_diff
+            logger.info('Sleeping for %.2fs', sleep_time)
             sleep(sleep_time)
-        self.last_request = time()
-        print('Sending GET Request')
-        url = f'{self.base_url}/{path}?{parse.urlencode(query)}'
-        self.requests.append({ "date": now, "url": url })
-        request_start_time = time()
-        res = requests.get(url)
-        print(f'[GET {res.status_code}] {url} took {time() - request_start_time:.2f}s')
-        if res.status_code != 200:
-            raise Exception(f'API returned {res.status_code}: {res.content.decode()}')
-        content = res.content.decode()
+        self.last_request = monotonic()
+
+    def slow_down(self, res: requests.Response):
+        # double the interval when rate limited, capped at 15 minutes
+        self.current_interval = max(self.request_interval, min(max(1, self.current_interval * 2), 15 * 60))
+        logger.warning('Rate limited, slowing down to one request every %ss', self.current_interval)
+        retry_after = res.headers.get('Retry-After', '')
+        if retry_after.isdigit():
+            logger.info('Server asked to retry after %ss', retry_after)
+            sleep(int(retry_after))
+
+    def get_conditional_headers(self, url: str) -> dict:
+        headers = {}
+        if url not in self.conditional_cache:
+            return headers
+        (etag, last_modified, _) = self.conditional_cache[url]
+        if etag is not None:
+            headers['If-None-Match'] = etag
+        if last_modified is not None:
+            headers['If-Modified-Since'] = last_modified
+        return headers
+
+    def get_api(self, path: str, query: Union[dict, str], raw = False, conditional = False):
+        logger.info('Getting from api %s with query %s', path, query)
+        # paginated calls pass an already encoded query string
+        query_string = query if isinstance(query, str) else parse.urlencode(query)
+        url = f'{self.base_url}/{path}?{query_string}'
+        headers = self.get_conditional_headers(url) if conditional else {}
+        attempts = 3
+        for attempt in range(attempts):
+            self.wait_for_rate_limit()
+            logger.info('Sending GET Request')
+            # formatted when the requests are saved
+            self.requests.append({ "date": time(), "url": url })
+            res = self.session.get(url, headers=headers, timeout=(5, 30))
+            logger.info('[GET %s] %s took %.2fs', res.status_code, url, monotonic() - self.last_request)
+            if res.status_code not in (429, 502, 503, 504) or attempt == attempts - 1:
+                break
+            if res.status_code == 429:
+                self.slow_down(res)
+            else:
+                logger.warning('Server unavailable, retrying')
+        if res.status_code == 304 and url in self.conditional_cache:
+            logger.info('Not modified, using the cached response')
+        elif res.status_code != 200:
+            raise Exception(f'API returned {res.status_code}: {res.text}')
+        # the server is keeping up, ease back towards the configured interval
+        self.current_interval = max(self.request_interval, self.current_interval - 1)
+        if res.status_code == 304:
+            return self.conditional_cache[url][2]
         if raw:
-            return content
-        return json.loads(content)
+            return res.text
+        data = json_loads(res.content)
+        etag = res.headers.get('ETag')
+        last_modified = res.headers.get('Last-Modified')
+        if conditional and (etag is not None or last_modified is not None):
+            self.conditional_cache[url] = (etag, last_modified, data)
+        return data
 
     def get_site(self):
         return self.get_api('site')
 
     def get_community_info(self, name: str):
-        return self.get_api('community', { 'name': name })
+        if name not in self.community_cache:
+            self.community_cache[name] = self.get_api('community', { 'name': name })
+        return self.community_cache[name]
 
     def get_posts(self, community: str, sort: str = 'New', page: int = 1) -> List[dict]:
-        print(f'Listing posts for community: {community}')
-        return self.get_api('post/list', {
-            'community_name': community,
-            'page': page,
-            'limit': self.list_limit,
-            'sort': sort
-        })['posts']
+        logger.info('Listing posts for community: %s', community)
+        if (community, sort) not in self.posts_query_cache:
+            self.posts_query_cache[(community, sort)] = parse.urlencode({
+                'community_name': community,
+                'limit': self.list_limit,
+                'sort': sort
+            })
+        query = self.posts_query_cache[(community, sort)]
+        # listing urls are few and fixed, unlike comment urls, so only these are cached
+        return self.get_api('post/list', f'{query}&page={page}', conditional=True)['posts']
     
-    def get_comments(self, post_id: str, community_name: str, expected_num: int, page: int = 1, acc: List[dict] = []) -> List[dict]:
-        print(f'Loading comments for post {post_id} in {community_name}')
-        comments = self.get_api('comment/list', {
+    def get_comments(self, post_id: str, community_name: str, expected_num: int, page: int = 1) -> List[dict]:
+        logger.info('Loading comments for post %s in %s', post_id, community_name)
+        query = parse.urlencode({
             'post_id': post_id,
             'community_name': community_name,
             'max_depth': 10,
             'sort': 'New',
-            'limit': 50,
-            'page': page
-        })['comments']
-        for com in comments:
-            acc.append(com)
-        if len(acc) < expected_num and len(comments) > 0:
-            return self.get_comments(post_id, community_name, expected_num, page + 1, acc)
+            'limit': 50
+        })
+        acc = []
+        while True:
+            comments = self.get_api('comment/list', f'{query}&page={page}')['comments']
+            if len(comments) == 0:
+                break
+            acc.extend(comments)
+            if len(acc) >= expected_num:
+                break
+            page += 1
         return acc
     
     def save_requests(self, file_name: str):
-        with open(file_name, 'a', encoding='utf-8') as f:
-            for req in self.requests:
-                f.write(json.dumps(req) + '\n')
+        lines = []
+        for req in self.requests:
+            date = datetime.fromtimestamp(req['date']).strftime("%m/%d/%Y, %H:%M:%S")
+            lines.append(json_dumps({ "date": date, "url": req['url'] }) + b'\n')
+        with open(file_name, 'ab') as f:
+            f.write(b''.join(lines))
         self.requests = []
 
 class Comment:
+    __slots__ = ('data',)
+
     def __init__(self, data: dict):
-        self.json = json.dumps(data)
+        self.data = data
+
+    @property
+    def json(self) -> str:
+        return self.json_bytes.decode()
+
+    @property
+    def json_bytes(self) -> bytes:
+        return json_dumps(self.data)
 
 class Post:
+    __slots__ = ('api', 'data', 'id', 'name', 'published', 'day', 'community', 'comments', 'num_comments')
+
     def __init__(self, api: LemmyApi, data: dict, community: str, comments: List[Comment] = None):
         self.api = api
-        self.json = json.dumps(data)
+        # serialized only when the post is saved, most listed posts never are
+        self.data = data
         self.id = data['post']['id']
         self.name = data['post']['name']
         self.published = data['post']['published']
+        self.day = get_date(self.published)
         self.community = community
         self.comments = None
         self.num_comments = data['counts']['comments']
@@ -102,120 +246,170 @@ class Post:
         else:
             self.comments = comments
 
+    @property
+    def json(self) -> str:
+        return self.json_bytes.decode()
+
+    @property
+    def json_bytes(self) -> bytes:
+        return json_dumps(self.data)
+
     def load_comments(self):
         if self.comments is not None:
             return
         data = self.api.get_comments(self.id, self.community, self.num_comments)
-        print(f'Loaded {len(data)} comments for post {self.id}')
+        logger.info('Loaded %d comments for post %s', len(data), self.id)
         self.comments = [Comment(comment) for comment in data]
 
 class PostList:
+    __slots__ = ('posts', 'api', 'ids', 'community')
+
     def __init__(self, api: LemmyApi, posts: List[Post], community: str):
         self.posts = posts
         self.api = api
-        self.ids = [post.id for post in posts]
+        self.ids = set(post.id for post in posts)
         self.community = community
 
     def add_to_posts(self, posts: List[dict]):
         for post in posts:
-            if post['post']['id'] in self.ids:
+            post_id = post['post']['id']
+            if post_id in self.ids:
                 continue
             self.posts.append(Post(self.api, post, self.community))
-            self.ids.append(post['post']['id'])
+            self.ids.add(post_id)
 
     @staticmethod
     def load_from_file(file_name: str, api: LemmyApi, community: str):
         if not os.path.exists(file_name):
-            return PostList(api, [])
-        posts = []
-        with open(file_name, 'r', encoding='utf-8') as f:
-            line = f.readline()
-            while line != None:
-                posts.append(Post(api, json.loads(line), community))
-                line = f.readline()
-        return PostList(api, posts)
+            return PostList(api, [], community)
+        with gzip.open(file_name, 'rb') as f:
+            posts = [Post(api, json_loads(line), community) for line in f]
+        return PostList(api, posts, community)
 
     @staticmethod
-    def load_ids_from_file(file_name: str):
-        ids = []
+    def load_ids_from_file(file_name: str) -> set:
+        ids = set()
         if not os.path.exists(file_name):
             return ids
-        with open(file_name, 'r', encoding='utf-8') as f:
-            line = f.readline()
-            while line != None and line != '':
-                data = json.loads(line)
-                ids.append(data['post']['id'])
-                line = f.readline()
+        with gzip.open(file_name, 'rb') as f:
+            for line in f:
+                match = POST_ID_PATTERN.match(line)
+                if match is not None:
+                    ids.add(int(match.group(1)))
+                else:
+                    ids.add(json_loads(line)['post']['id'])
         return ids
 
-    def get_posts_for_day(self, start_idx: int):
-        idx = start_idx
-        start_day = get_date(self.posts[idx].published)
-        current_day = start_day
-        day_posts = [self.posts[idx]]
-        while idx < len(self.posts) and start_day == current_day:
-            idx += 1
-            if idx >= len(self.posts):
-                break
-            day_posts.append(self.posts[idx])
-            current_day = get_date(self.posts[idx].published).day
-        if start_day == current_day:
-            return ([], -1)
-        return (day_posts, idx)
-
-    def save_to_file(self):
-        if len(self.posts) == 0:
-            return
-        # find the day of the begginning of the post list
-        # step index until we hit the first post of the day before
-        (_, idx) = self.get_posts_for_day(0)
-        if idx == -1:
-            return
-        save_posts = []
-        while idx != -1:
-            (posts, idx) = self.get_posts_for_day(idx)
-            if idx == -1:
-                break
-            if len(posts) == 0:
+    def save_to_file(self, saved_ids: set, newest_day: datetime, oldest_day: datetime = None):
+        # only days strictly between oldest_day and newest_day are known to be
+        # complete, oldest_day is None when the listing reached the first post
+        for (day, day_posts) in groupby(self.posts, key=lambda post: post.day):
+            if day >= newest_day or (oldest_day is not None and day <= oldest_day):
                 continue
-            for p in posts:
-                save_posts.append(p)
-            post_date = get_date(posts[0].published)
-            with open(f'data/comments_{self.community}_{post_date.year}_{post_date.month}_{post_date.day}.jsonl.gz', 'wb') as f:
-                file_data = ''
-                for post in posts:
-                    post.load_comments()
-                    for comment in post.comments:
-                        file_data += comment.json + '\n'
-                f.write(gzip.compress(file_data.encode()))
-        with open(f'data/posts_{self.community}.jsonl', 'a', encoding='utf-8') as f:
-            for post in save_posts:
-                f.write(post.json + '\n')
+            posts = list(day_posts)
+            for post in posts:
+                post.load_comments()
+            with deferred_stop_signals():
+                with gzip.open(f'data/comments_{self.community}_{day.year}_{day.month}_{day.day}.jsonl.gz', 'ab', compresslevel=6) as f:
+                    for post in posts:
+                        for comment in post.comments:
+                            f.write(comment.json_bytes)
+                            f.write(b'\n')
+                # mark the day saved right away, a later day failing must not
+                # leave these comments on disk for posts that would be fetched again
+                with gzip.open(f'data/posts_{self.community}.jsonl.gz', 'ab') as f:
+                    f.writelines(post.json_bytes + b'\n' for post in posts)
+                saved_ids.update(post.id for post in posts)
+
+# file name -> (mtime, ids), so unchanged post files are not re-read every sync
+saved_ids_cache = {}
+
+def get_mtime(file_name: str):
+    if not os.path.exists(file_name):
+        return None
+    return os.stat(file_name).st_mtime_ns
+
+def get_saved_ids(file_name: str) -> set:
+    mtime = get_mtime(file_name)
+    if file_name in saved_ids_cache:
+        (cached_mtime, ids) = saved_ids_cache[file_name]
+        if cached_mtime == mtime:
+            return ids
+    ids = PostList.load_ids_from_file(file_name)
+    saved_ids_cache[file_name] = (mtime, ids)
+    return ids
+
+def compress_posts_file(file_name: str):
+    # posts used to be saved uncompressed, move them into the gzip file
+    if not os.path.exists(file_name):
+        return
+    logger.info('Compressing %s', file_name)
+    gz_file_name = file_name + '.gz'
+    # build the result next to it so an interrupted run never touches the history
+    tmp_file_name = gz_file_name + '.tmp'
+    with open(tmp_file_name, 'wb') as dst:
+        if os.path.exists(gz_file_name):
+            with open(gz_file_name, 'rb') as src:
+                shutil.copyfileobj(src, dst)
+        with open(file_name, 'rb') as src, gzip.GzipFile(fileobj=dst, mode='wb') as gz:
+            shutil.copyfileobj(src, gz)
+    with deferred_stop_signals():
+        os.replace(tmp_file_name, gz_file_name)
+        os.remove(file_name)
 
 def sync_community(api: LemmyApi, community: str, max_page: int, min_post_age: int):
-    saved_posts_file = f'data/posts_{community}.jsonl'
-    saved_ids = PostList.load_ids_from_file(saved_posts_file)
-    print(f'Loaded {len(saved_ids)} ids from {saved_posts_file}')
-    new_posts = PostList(api, [], community)
+    compress_posts_file(f'data/posts_{community}.jsonl')
+    saved_posts_file = f'data/posts_{community}.jsonl.gz'
+    saved_ids = get_saved_ids(saved_posts_file)
+    logger.info('Loaded %d ids from %s', len(saved_ids), saved_posts_file)
+    # lemmy timestamps are utc
+    max_published = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(hours=min_post_age)
+    # the day holding the cutoff still has posts too young to save
+    newest_day = get_date(max_published.isoformat())
+    # decided from the whole listing, saved posts included, so a day is not
+    # mistaken for a partial one just because its older neighbour was saved
+    oldest_listed_day = None
+    listing_exhausted = False
+    listed_posts = []
     for page in range(1, max_page + 1):
         posts_for_page = api.get_posts(community, 'New', page)
-        print(f'{community}: page {page} returned {len(posts_for_page)} posts')
+        logger.info('%s: page %d returned %d posts', community, page, len(posts_for_page))
         for post in posts_for_page:
+            day = get_date(post['post']['published'])
+            if oldest_listed_day is None or day < oldest_listed_day:
+                oldest_listed_day = day
             if post['post']['id'] in saved_ids:
                 continue
-            date = get_date(post['post']['published'])
-            new_posts.add_to_posts([post])
-    print(f'Saving {len(new_posts.posts)} new posts to {saved_posts_file}')
-    new_posts.save_to_file()
+            if datetime.fromisoformat(post['post']['published'][:19]) > max_published:
+                continue
+            listed_posts.append(post)
+        if len(posts_for_page) < api.list_limit:
+            listing_exhausted = True
+            break
+    # with more pages left, older posts from the oldest listed day may be missing
+    oldest_day = None if listing_exhausted else oldest_listed_day
+    new_posts = PostList(api, [], community)
+    new_posts.add_to_posts(listed_posts)
+    logger.info('Saving %d new posts to %s', len(new_posts.posts), saved_posts_file)
+    try:
+        new_posts.save_to_file(saved_ids, newest_day, oldest_day)
+    finally:
+        # saved_ids already holds every day written, even if a later one failed
+        saved_ids_cache[saved_posts_file] = (get_mtime(saved_posts_file), saved_ids)
 
 def sync_communities(api: LemmyApi, communities: List[str], max_page: int, min_post_age: int):
     for community in communities:
         try:
             sync_community(api, community, max_page, min_post_age)
-        except:
-            print(traceback.format_exc())
+        except Exception:
+            logger.exception('Failed to sync community %s', community)
             sleep(10)
 
+def stop(signum, frame):
+    # raised wherever we are, even mid sleep, so the with and finally blocks run
+    logger.info('Received signal %d, stopping', signum)
+    raise SystemExit(0)
+
 def get_with_default(prop: str, obj: dict, default: any) -> any:
     if prop in obj:
         return obj[prop]
@@ -226,11 +420,17 @@ def ensure_prop(prop: str, obj: dict):
         raise Exception(f'Could not find required property "{prop}" in config.json')
     return obj[prop]
 
+logging.basicConfig(
+    level=logging.INFO,
+    format='[%(asctime)s] %(levelname)s %(message)s',
+    datefmt='%m/%d/%Y, %H:%M:%S'
+)
+
 config = {}
 if not os.path.exists('config.json'):
     raise Exception('Could not find config.json')
 
-print('Config file found, reading config...')
+logger.info('Config file found, reading config...')
 with open('config.json', 'r', encoding='utf-8') as f:
     config = json.loads(f.read())
 
@@ -248,26 +448,36 @@ sync_interval = int(sync_interval * 60 * 60)
 request_interval = get_with_default('request_interval', config, 20)
 min_post_age = get_with_default('min_post_age', config, 24)
 
-print(f"""
+logger.info("""
 Config:
-base url: {base_url}
-communities: {str(communities)}
-requests file: {requests_file}
-max page: {max_page}
-list limit: {list_limit}
-sync interval {int(sync_interval / 60 / 60)} hours
-request interval: {request_interval} seconds
-minimum post age: {min_post_age} hours
-""")
-
-api = LemmyApi(base_url, request_interval, list_limit)
+base url: %s
+communities: %s
+requests file: %s
+max page: %s
+list limit: %s
+sync interval %d hours
+request interval: %s seconds
+minimum post age: %s hours
+""", base_url, communities, requests_file, max_page, list_limit, sync_interval / 60 / 60, request_interval, min_post_age)
 
 if not os.path.exists('data'):
     os.mkdir('data')
 
-while True:
-    print(f'Syncing Communities')
-    sync_communities(api, communities, max_page, min_post_age)
-    api.save_requests(requests_file)
-    print(f'Communities Synced, sleeping for {sync_interval // (60 * 60)} hours')
-    sleep(sync_interval)
\ No newline at end of file
+signal.signal(signal.SIGTERM, stop)
+
+with LemmyApi(base_url, request_interval, list_limit) as api:
+    try:
+        while True:
+            logger.info('Syncing Communities')
+            sync_start_time = monotonic()
+            sync_communities(api, communities, max_page, min_post_age)
+            api.save_requests(requests_file)
+            # no point holding connections open for hours between syncs
+            api.close()
+            # the sync itself is mostly rate limit waits, count it towards the interval
+            sleep_time = max(0, sync_interval - (monotonic() - sync_start_time))
+            logger.info('Communities Synced, sleeping for %.2f hours', sleep_time / (60 * 60))
+            sleep(sleep_time)
+    finally:
+        # keep the log of calls made by an interrupted sync
+        api.save_requests(requests_file)
\ No newline at end of file